@@ -11,10 +11,11 @@ INSTALL_REQUIRES = [
     # generic
     "numpy",
     "tqdm",
+    "joblib",
     "kornia>=0.6.5",
     "pip",
     "torchvision",
-    "torch>=1.21",
+    "torch>=2.4",
     "torchmetrics",
     "pytorch_lightning>=1.6.5",
     "pytest",
@@ -8,7 +8,6 @@
 import torch
 from .dino import vision_transformer as vits
 from torch import nn
-import numpy as np
 from abc import ABC, abstractmethod
 
 
@@ -21,6 +20,11 @@ def get_backbone(cfg):
     if not hasattr(cfg, "backbone"):
         raise ValueError("Could not find 'backbone' option in the config file. Please check it")
 
+    if cfg.get("hub_cache_dir", None):
+        # Point torch.hub at a persistent cache so backbone code and weights
+        # are downloaded once and reused across runs (e.g. on cluster scratch).
+        torch.hub.set_dir(cfg.hub_cache_dir)
+
     if cfg.backbone == "dino":
         return DinoViT(cfg)
     elif cfg.backbone == "dinov2":
@@ -45,6 +49,20 @@ class Backbone(ABC, nn.Module):
         "vit_giant": "G",
     }
 
+    autocast_dtypes = {
+        "float32": None,
+        "float16": torch.float16,
+        "bfloat16": torch.bfloat16,
+    }
+
+    # Resolve the autocast dtype for backbone inference from the config.
+    # Returns None when the backbone should run in full FP32.
+    def _resolve_autocast_dtype(self, cfg):
+        dtype_name = cfg.get("backbone_dtype", "float32")
+        if dtype_name not in Backbone.autocast_dtypes:
+            raise ValueError("Backbone dtype {} unavailable".format(dtype_name))
+        return Backbone.autocast_dtypes[dtype_name]
+
     # Initialize the backbone
     @abstractmethod
     def __init__(self, cfg):
@@ -86,7 +104,19 @@ class Dinov2ViT(Backbone):
         for p in self.model.parameters():
             p.requires_grad = False
         self.model.eval().cuda()
-        self.dropout = torch.nn.Dropout2d(p=np.clip(self.cfg.dropout_p, 0.0, 1.0))
+        if self.cfg.get("compile_backbone", False):
+            # Compile the feature extraction entry point (forward is not used by STEGO;
+            # compiling the module would leave get_intermediate_layers eager).
+            # Inputs are fixed multiples of patch_size, so Inductor can specialize kernels without recompiles.
+            self.model.get_intermediate_layers = torch.compile(
+                self.model.get_intermediate_layers, mode="reduce-overhead", dynamic=False
+            )
+        self.autocast_dtype = self._resolve_autocast_dtype(self.cfg)
+        self.channels_last = self.cfg.get("channels_last", False)
+        if self.cfg.dropout_p > 0:
+            self.dropout = torch.nn.Dropout2d(p=min(self.cfg.dropout_p, 1.0))
+        else:
+            self.dropout = torch.nn.Identity()
 
         if self.backbone_type == "vit_small":
             self.n_feats = 384
@@ -103,17 +133,28 @@ class Dinov2ViT(Backbone):
             assert img.shape[3] % self.patch_size == 0
 
             # get selected layer activations
-            feat = self.model.get_intermediate_layers(img)[0]
+            with torch.autocast(
+                device_type="cuda",
+                dtype=self.autocast_dtype or torch.bfloat16,
+                enabled=self.autocast_dtype is not None,
+            ):
+                feat = self.model.get_intermediate_layers(img)[0]
+            # Keep the segmentation head numerically safe regardless of the backbone dtype.
+            feat = feat.float()
 
             feat_h = img.shape[2] // self.patch_size
             feat_w = img.shape[3] // self.patch_size
 
-            image_feat = feat[:, :, :].reshape(feat.shape[0], feat_h, feat_w, -1).permute(0, 3, 1, 2)
+            if self.channels_last:
+                # The token sequence is already laid out channels-last in memory,
+                # so this permuted view is a zero-copy channels_last tensor.
+                image_feat = feat.reshape(feat.shape[0], feat_h, feat_w, -1).permute(0, 3, 1, 2)
+            else:
+                # Transpose the token and channel dims first so the reshape yields
+                # a contiguous NCHW tensor instead of a permuted view.
+                image_feat = feat.transpose(1, 2).reshape(feat.shape[0], -1, feat_h, feat_w)
 
-        if self.cfg.dropout_p > 0:
-            return self.dropout(image_feat)
-        else:
-            return image_feat
+        return self.dropout(image_feat)
 
     def get_backbone_name(self):
         return "DINOv2-" + Backbone.vit_name_long_to_short[self.backbone_type] + "-" + str(self.patch_size)
@@ -129,7 +170,12 @@ class DinoViT(Backbone):
         for p in self.model.parameters():
             p.requires_grad = False
         self.model.eval().cuda()
-        self.dropout = torch.nn.Dropout2d(p=np.clip(self.cfg.dropout_p, 0.0, 1.0))
+        self.autocast_dtype = self._resolve_autocast_dtype(self.cfg)
+        self.channels_last = self.cfg.get("channels_last", False)
+        if self.cfg.dropout_p > 0:
+            self.dropout = torch.nn.Dropout2d(p=min(self.cfg.dropout_p, 1.0))
+        else:
+            self.dropout = torch.nn.Identity()
 
         if self.backbone_type == "vit_small" and self.patch_size == 16:
             url = "dino_deitsmall16_pretrain/dino_deitsmall16_pretrain.pth"
@@ -142,24 +188,38 @@ class DinoViT(Backbone):
         else:
             raise ValueError("Model type {} unavailable with patch size {}".format(self.backbone_type, self.patch_size))
 
-        if cfg.pretrained_weights is not None:
-            state_dict = torch.load(cfg.pretrained_weights, map_location="cpu")
+        self._load_pretrained_weights(url)
+
+        if self.cfg.get("compile_backbone", False):
+            # Compile the feature extraction entry point (forward is not used by STEGO).
+            # Inputs are fixed multiples of patch_size, so Inductor can specialize kernels without recompiles.
+            self.model.get_intermediate_feat = torch.compile(
+                self.model.get_intermediate_feat, mode="reduce-overhead", dynamic=False
+            )
+
+        if self.backbone_type == "vit_small":
+            self.n_feats = 384
+        else:
+            self.n_feats = 768
+
+    def _load_pretrained_weights(self, url):
+        # Map the state_dict straight onto the GPU (the model already lives there),
+        # skipping the CPU staging copy and per-tensor host-to-device transfers.
+        if self.cfg.pretrained_weights is not None:
+            state_dict = torch.load(self.cfg.pretrained_weights, map_location="cuda", weights_only=True)
             # remove `module.` prefix
             state_dict = {k.replace("module.", ""): v for k, v in state_dict.items()}
             # remove `backbone.` prefix induced by multicrop wrapper
             state_dict = {k.replace("backbone.", ""): v for k, v in state_dict.items()}
             msg = self.model.load_state_dict(state_dict, strict=False)
-            print("Pretrained weights found at {} and loaded with msg: {}".format(cfg.pretrained_weights, msg))
+            print("Pretrained weights found at {} and loaded with msg: {}".format(self.cfg.pretrained_weights, msg))
         else:
             print("Since no pretrained weights have been provided, we load the reference pretrained DINO weights.")
-            state_dict = torch.hub.load_state_dict_from_url(url="https://dl.fbaipublicfiles.com/dino/" + url)
+            state_dict = torch.hub.load_state_dict_from_url(
+                url="https://dl.fbaipublicfiles.com/dino/" + url, map_location="cuda", weights_only=True
+            )
             self.model.load_state_dict(state_dict, strict=True)
 
-        if self.backbone_type == "vit_small":
-            self.n_feats = 384
-        else:
-            self.n_feats = 768
-
     def get_output_feat_dim(self):
         return self.n_feats
 
@@ -170,18 +230,29 @@ class DinoViT(Backbone):
             assert img.shape[3] % self.patch_size == 0
 
             # get selected layer activations
-            feat, attn, qkv = self.model.get_intermediate_feat(img)
+            with torch.autocast(
+                device_type="cuda",
+                dtype=self.autocast_dtype or torch.bfloat16,
+                enabled=self.autocast_dtype is not None,
+            ):
+                feat, attn, qkv = self.model.get_intermediate_feat(img)
             feat, attn, qkv = feat[0], attn[0], qkv[0]
+            # Keep the segmentation head numerically safe regardless of the backbone dtype.
+            feat = feat.float()
 
             feat_h = img.shape[2] // self.patch_size
             feat_w = img.shape[3] // self.patch_size
 
-            image_feat = feat[:, 1:, :].reshape(feat.shape[0], feat_h, feat_w, -1).permute(0, 3, 1, 2)
+            if self.channels_last:
+                # The token sequence is already laid out channels-last in memory,
+                # so this permuted view is a zero-copy channels_last tensor.
+                image_feat = feat[:, 1:, :].reshape(feat.shape[0], feat_h, feat_w, -1).permute(0, 3, 1, 2)
+            else:
+                # Transpose the token and channel dims first so the reshape yields
+                # a contiguous NCHW tensor instead of a permuted view.
+                image_feat = feat[:, 1:, :].transpose(1, 2).reshape(feat.shape[0], -1, feat_h, feat_w)
 
-        if self.cfg.dropout_p > 0:
-            return self.dropout(image_feat)
-        else:
-            return image_feat
+        return self.dropout(image_feat)
 
     def get_backbone_name(self):
         return "DINO-" + Backbone.vit_name_long_to_short[self.backbone_type] + "-" + str(self.patch_size)
@@ -23,7 +23,7 @@ class SegmentationHead(nn.Module):
     STEGO's segmentation head module.
     """
 
-    def __init__(self, input_dim, dim):
+    def __init__(self, input_dim, dim, cfg=None):
         super().__init__()
         self.linear = torch.nn.Sequential(torch.nn.Conv2d(input_dim, dim, (1, 1)))
         self.nonlinear = torch.nn.Sequential(
@@ -31,6 +31,11 @@ class SegmentationHead(nn.Module):
             torch.nn.ReLU(),
             torch.nn.Conv2d(input_dim, dim, (1, 1)),
         )
+        if cfg is not None and cfg.get("compile_head", False):
+            # The head is a chain of memory-bound 1x1 convs and pointwise ops;
+            # compiling the bound method (instead of the module) keeps the
+            # state_dict keys unchanged while letting Inductor fuse both branches.
+            self.forward = torch.compile(self.forward, mode="max-autotune")
 
     def forward(self, inputs):
         return self.linear(inputs) + self.nonlinear(inputs)
@@ -47,15 +52,32 @@ class ClusterLookup(nn.Module):
         self.n_classes = n_classes
         self.dim = dim
         self.clusters = torch.nn.Parameter(torch.randn(n_classes, dim))
+        self._normed_clusters = None
 
     def reset_parameters(self):
         with torch.no_grad():
             self.clusters.copy_(torch.randn(self.n_classes, self.dim))
+        self._normed_clusters = None
+
+    def train(self, mode=True):
+        # The cached normalized clusters are only valid while the parameters
+        # are frozen, i.e. in eval mode; drop them on any mode switch.
+        self._normed_clusters = None
+        return super().train(mode)
 
     def forward(self, x, alpha, log_probs=False):
-        normed_clusters = F.normalize(self.clusters, dim=1)
+        if self.training:
+            normed_clusters = F.normalize(self.clusters, dim=1)
+        else:
+            # The clusters do not change between eval forwards, so normalize once.
+            if self._normed_clusters is None:
+                self._normed_clusters = F.normalize(self.clusters, dim=1)
+            normed_clusters = self._normed_clusters
         normed_features = F.normalize(x, dim=1)
-        inner_products = torch.einsum("bchw,nc->bnhw", normed_features, normed_clusters)
+        # (n, c) @ (b, c, h*w) -> (b, n, h*w); a plain batched matmul hits the
+        # cuBLAS fast path directly instead of going through einsum dispatch.
+        b, c, h, w = normed_features.shape
+        inner_products = (normed_clusters @ normed_features.reshape(b, c, h * w)).reshape(b, -1, h, w)
 
         if alpha is None:
             cluster_probs = (
@@ -84,21 +106,31 @@ class ContrastiveCorrelationLoss(nn.Module):
     ):
         super(ContrastiveCorrelationLoss, self).__init__()
         self.cfg = cfg
+        if cfg.get("compile_loss", False):
+            # The helper is a fixed chain of normalize/correlation/clamp ops
+            # over static shapes; max-autotune fuses the pointwise tail into
+            # the correlation contractions.
+            self.helper = torch.compile(self.helper, mode="max-autotune")
 
     def standard_scale(self, t):
         t1 = t - t.mean()
         t2 = t1 / t1.std()
         return t2
 
-    def helper(self, f1, f2, c1, c2, shift):
+    def helper(self, f1, f2, c1, c2, shift, groups=1):
         with torch.no_grad():
             # Comes straight from backbone which is currently frozen. this saves mem.
             fd = tensor_correlation(norm(f1), norm(f2))
 
             if self.cfg.pointwise:
-                old_mean = fd.mean()
-                fd -= fd.mean([3, 4], keepdim=True)
-                fd = fd - fd.mean() + old_mean
+                # Take the scalar correction means per permutation group, so a
+                # batched call over groups stacked along the batch dimension is
+                # equivalent to calling the helper once per group.
+                fd = fd.reshape(groups, -1, *fd.shape[1:])
+                old_mean = fd.mean([1, 2, 3, 4, 5], keepdim=True)
+                fd -= fd.mean([4, 5], keepdim=True)
+                fd = fd - fd.mean([1, 2, 3, 4, 5], keepdim=True) + old_mean
+                fd = fd.reshape(-1, *fd.shape[2:])
 
         cd = tensor_correlation(norm(c1), norm(c2))
 
@@ -138,17 +170,21 @@ class ContrastiveCorrelationLoss(nn.Module):
         pos_intra_loss, pos_intra_cd = self.helper(feats, feats, code, code, self.cfg.pos_intra_shift)
         pos_inter_loss, pos_inter_cd = self.helper(feats, feats_pos, code, code_pos, self.cfg.pos_inter_shift)
 
-        neg_losses = []
-        neg_cds = []
-        for i in range(self.cfg.neg_samples):
-            perm_neg = super_perm(orig_feats.shape[0], orig_feats.device)
-            feats_neg = sample(orig_feats[perm_neg], coords2)
-            code_neg = sample(orig_code[perm_neg], coords2)
-            neg_inter_loss, neg_inter_cd = self.helper(feats, feats_neg, code, code_neg, self.cfg.neg_inter_shift)
-            neg_losses.append(neg_inter_loss)
-            neg_cds.append(neg_inter_cd)
-        neg_inter_loss = torch.cat(neg_losses, axis=0)
-        neg_inter_cd = torch.cat(neg_cds, axis=0)
+        # Stack all negative permutations along the batch dimension and run a
+        # single batched helper call instead of neg_samples sequential ones.
+        neg_samples = self.cfg.neg_samples
+        perms_neg = torch.cat([super_perm(orig_feats.shape[0], orig_feats.device) for _ in range(neg_samples)])
+        coords_neg = coords2.repeat(neg_samples, 1, 1, 1)
+        feats_neg = sample(orig_feats[perms_neg], coords_neg)
+        code_neg = sample(orig_code[perms_neg], coords_neg)
+        neg_inter_loss, neg_inter_cd = self.helper(
+            feats.repeat(neg_samples, 1, 1, 1),
+            feats_neg,
+            code.repeat(neg_samples, 1, 1, 1),
+            code_neg,
+            self.cfg.neg_inter_shift,
+            groups=neg_samples,
+        )
 
         return (
             pos_intra_loss.mean(),
@@ -351,7 +387,7 @@ class KMeans:
 
             # Handle empty clusters by replacing them with a random point
             empty_clusters = num_points.squeeze() == 0
-            random_points = X[torch.randint(len(X), (torch.sum(empty_clusters),))]
+            random_points = X[torch.randint(len(X), (int(empty_clusters.sum()),), device=X.device)]
             sum_points[empty_clusters, :] = random_points
             num_points[empty_clusters] = 1
 
@@ -12,16 +12,23 @@ import pytorch_lightning as pl
 import omegaconf
 import os
 import wandb
+from joblib import Parallel, delayed
 import matplotlib as plt
 import io
 
 
 from stego.backbones.backbone import get_backbone
-from stego.utils import UnsupervisedMetrics
+from stego.utils import UnsupervisedMetrics, to_pinned_cpu
 from stego.data import Image
 from stego.modules import SegmentationHead, ClusterLookup, ContrastiveCorrelationLoss, CRF, KMeans
 
 
+def _dense_crf_argmax(crf, img, probs):
+    # Runs in a worker process. Return only the small argmax map instead of
+    # the full class-probability volume to keep the pickled payload minimal.
+    return crf.dense_crf(img, probs).argmax(0)
+
+
 class Stego(pl.LightningModule):
     """
     The main STEGO class.
@@ -42,11 +49,17 @@ class Stego(pl.LightningModule):
         self.full_backbone_name = self.backbone.get_backbone_name()
         self.backbone.eval()
         self.backbone_dim = self.backbone.get_output_feat_dim()
-        self.segmentation_head = SegmentationHead(self.backbone_dim, self.dim)
+        self.segmentation_head = SegmentationHead(self.backbone_dim, self.dim, self.cfg)
 
         self.cluster_probe = ClusterLookup(self.dim, self.n_classes + self.cfg.extra_clusters)
         self.linear_probe = nn.Conv2d(self.dim, n_classes, (1, 1))
 
+        if self.cfg.get("channels_last", False):
+            # Match the channels_last features produced by the backbone so the
+            # 1x1 convs run on the tensor-core NHWC path without reordering.
+            self.segmentation_head = self.segmentation_head.to(memory_format=torch.channels_last)
+            self.linear_probe = self.linear_probe.to(memory_format=torch.channels_last)
+
         self.cluster_metrics = UnsupervisedMetrics("test/cluster/", n_classes, self.cfg.extra_clusters, True)
         self.linear_metrics = UnsupervisedMetrics("test/linear/", n_classes, 0, False)
 
@@ -67,7 +80,11 @@ class Stego(pl.LightningModule):
             max_iterations=100,
         )
 
-        self.cd_hist = torch.zeros(40)
+        # Non-persistent buffer so Lightning keeps it on the module's device
+        # without adding it to checkpoints.
+        self.register_buffer("cd_hist", torch.zeros(40), persistent=False)
+        # Bin centers of cd_hist, kept on CPU for plotting.
+        self.cd_hist_bins = torch.linspace(-1 + 1 / 40, 1 - 1 / 40, 40)
 
         self.save_hyperparameters()
 
@@ -78,6 +95,8 @@ class Stego(pl.LightningModule):
         self.cluster_probe = ClusterLookup(self.dim, n_classes + extra_clusters)
         self.cluster_metrics = UnsupervisedMetrics("test/cluster/", n_classes, extra_clusters, True)
         self.linear_probe = nn.Conv2d(self.dim, n_classes, (1, 1))
+        if self.cfg.get("channels_last", False):
+            self.linear_probe = self.linear_probe.to(memory_format=torch.channels_last)
         self.linear_metrics = UnsupervisedMetrics("test/linear/", n_classes, 0, False)
         self.n_classes = n_classes
 
@@ -95,26 +114,37 @@ class Stego(pl.LightningModule):
     def get_code(self, img):
         """
         Returns segmentation features for a given image.
-        Returned features are an average of two passes through STEGO, with the input image and its horizontal flip.
+        Returned features are an average over the input image and its horizontal flip,
+        computed in a single batched pass through STEGO.
         """
-        # code1 = self.forward(img)[1]
-        # code2 = self.forward(img.flip(dims=[3]))[1]
-        # code = (code1 + code2.flip(dims=[3])) / 2
-        # return code
-        code = self.forward(img)[1]
-        return code
+        both = torch.cat([img, img.flip(dims=[3])], dim=0)
+        code = self.forward(both)[1]
+        code1, code2 = code.chunk(2, dim=0)
+        return (code1 + code2.flip(dims=[3])) / 2
 
     def postprocess_crf(self, img, probs):
         """
         Performs the CRF postprocessing step on the given image and a set of predicted class probabilities.
         The class probabilities are interpolated to fit the image size inside the dense_crf function.
+        The images of the batch are processed in parallel worker processes: pydensecrf holds the GIL
+        for the whole solve, so threads would serialize and processes are needed to use one core per image.
         """
-        pred = torch.empty(torch.Size(img.size()[:-3] + img.size()[-2:]))
-        for j in range(img.shape[0]):
-            single_img = img[j]
-            x = self.crf.dense_crf(single_img, probs[j]).argmax(0)
+        device = img.device
+        # Stage both tensors through pinned host memory so the device-to-host
+        # copies overlap, then synchronize once before the workers read them.
+        img = to_pinned_cpu(img.detach())
+        probs = to_pinned_cpu(probs.detach())
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        outputs = Parallel(n_jobs=min(img.shape[0], os.cpu_count() or 1), backend="loky")(
+            delayed(_dense_crf_argmax)(self.crf, img[j], probs[j]) for j in range(img.shape[0])
+        )
+        # Preallocate the predictions on the input device and copy each argmax
+        # row in directly, skipping the intermediate stacked CPU tensor.
+        pred = torch.empty(torch.Size(img.size()[:-3] + img.size()[-2:]), dtype=torch.int32, device=device)
+        for j, x in enumerate(outputs):
             pred[j] = x
-        return pred.int()
+        return pred
 
     def postprocess_cluster(self, code, img, use_crf=True, image_clustering=False):
         """
@@ -189,9 +219,9 @@ class Stego(pl.LightningModule):
 
     def training_step(self, batch, batch_idx):
         net_optim, linear_probe_optim, cluster_probe_optim = self.optimizers()
-        net_optim.zero_grad()
-        linear_probe_optim.zero_grad()
-        cluster_probe_optim.zero_grad()
+        net_optim.zero_grad(set_to_none=True)
+        linear_probe_optim.zero_grad(set_to_none=True)
+        cluster_probe_optim.zero_grad(set_to_none=True)
         log_args = dict(sync_dist=False, rank_zero_only=True)
 
         with torch.no_grad():
@@ -219,16 +249,22 @@ class Stego(pl.LightningModule):
         pos_intra_loss = pos_intra_loss.mean()
         pos_inter_loss = pos_inter_loss.mean()
 
-        self.cd_hist = torch.add(self.cd_hist, torch.histc(pos_intra_cd.cpu(), bins=40, min=-1, max=1))
-        self.cd_hist = torch.add(self.cd_hist, torch.histc(pos_inter_cd.cpu(), bins=40, min=-1, max=1))
-        self.cd_hist = torch.add(self.cd_hist, torch.histc(neg_inter_cd.cpu(), bins=40, min=-1, max=1))
-
-        self.log("loss/pos_intra", pos_intra_loss)
-        self.log("loss/pos_inter", pos_inter_loss)
-        self.log("loss/neg_inter", neg_inter_loss)
-        self.log("cd/pos_intra", pos_intra_cd.mean())
-        self.log("cd/pos_inter", pos_inter_cd.mean())
-        self.log("cd/neg_inter", neg_inter_cd.mean())
+        with torch.no_grad():
+            # The three histograms share the same bins, so one histc over the
+            # concatenated values equals the sum of the per-tensor histograms.
+            all_cds = torch.cat([pos_intra_cd.flatten(), pos_inter_cd.flatten(), neg_inter_cd.flatten()])
+            self.cd_hist += torch.histc(all_cds, bins=40, min=-1, max=1)
+
+        self.log_dict(
+            {
+                "loss/pos_intra": pos_intra_loss,
+                "loss/pos_inter": pos_inter_loss,
+                "loss/neg_inter": neg_inter_loss,
+                "cd/pos_intra": pos_intra_cd.mean(),
+                "cd/pos_inter": pos_inter_cd.mean(),
+                "cd/neg_inter": neg_inter_cd.mean(),
+            }
+        )
 
         loss = (
             self.cfg.pos_inter_weight * pos_inter_loss
@@ -239,20 +275,27 @@ class Stego(pl.LightningModule):
         flat_label = label.reshape(-1)
         mask = (flat_label >= 0) & (flat_label < self.n_classes)
 
-        detached_code = torch.clone(code.detach())
+        # The probes only read the code, so a detached view is enough;
+        # cloning would copy the full feature map every step.
+        detached_code = code.detach()
 
         linear_logits = self.linear_probe(detached_code)
         linear_logits = F.interpolate(linear_logits, label.shape[-2:], mode="bilinear", align_corners=False)
         linear_logits = linear_logits.permute(0, 2, 3, 1).reshape(-1, self.n_classes)
         linear_loss = self.linear_probe_loss_fn(linear_logits[mask], flat_label[mask]).mean()
         loss += linear_loss
-        self.log("loss/linear", linear_loss, **log_args)
 
         cluster_loss, cluster_probs = self.cluster_probe(detached_code, None)
         loss += cluster_loss
 
-        self.log("loss/cluster", cluster_loss, **log_args)
-        self.log("loss/total", loss, **log_args)
+        self.log_dict(
+            {
+                "loss/linear": linear_loss,
+                "loss/cluster": cluster_loss,
+                "loss/total": loss,
+            },
+            **log_args,
+        )
 
         self.manual_backward(loss)
         net_optim.step()
@@ -265,7 +308,7 @@ class Stego(pl.LightningModule):
         img = batch["img"]
         label = batch["label"]
 
-        with torch.no_grad():
+        with torch.inference_mode():
             code = self.forward(img)[1]
             code = F.interpolate(code, label.shape[-2:], mode="bilinear", align_corners=False)
 
@@ -277,14 +320,6 @@ class Stego(pl.LightningModule):
             cluster_preds = cluster_preds.argmax(1)
             self.cluster_metrics.update(cluster_preds, label)
 
-            linear_metrics = self.linear_metrics.compute()
-            cluster_metrics = self.cluster_metrics.compute()
-
-            self.log("val/linear/mIoU", linear_metrics["test/linear/mIoU"])
-            self.log("val/linear/Accuracy", linear_metrics["test/linear/Accuracy"])
-            self.log("val/cluster/mIoU", cluster_metrics["test/cluster/mIoU"])
-            self.log("val/cluster/Accuracy", cluster_metrics["test/cluster/Accuracy"])
-
             return {
                 "img": img[: self.cfg.val_n_imgs].detach().cpu(),
                 "linear_preds": linear_preds[: self.cfg.val_n_imgs].detach().cpu(),
@@ -295,6 +330,18 @@ class Stego(pl.LightningModule):
     def on_validation_epoch_end(self, outputs) -> None:
         super().on_validation_epoch_end(outputs)
         with torch.no_grad():
+            # Computing the metrics involves the Hungarian assignment over the
+            # full confusion matrix, so do it once per epoch, not per batch.
+            linear_metrics = self.linear_metrics.compute()
+            cluster_metrics = self.cluster_metrics.compute()
+            self.log_dict(
+                {
+                    "val/linear/mIoU": linear_metrics["test/linear/mIoU"],
+                    "val/linear/Accuracy": linear_metrics["test/linear/Accuracy"],
+                    "val/cluster/mIoU": cluster_metrics["test/cluster/mIoU"],
+                    "val/cluster/Accuracy": cluster_metrics["test/cluster/Accuracy"],
+                }
+            )
             self.linear_metrics.reset()
             self.cluster_metrics.reset()
 
@@ -314,11 +361,10 @@ class Stego(pl.LightningModule):
             )
             self.logger.experiment.log({"Image" + str(i): vis})
 
-        self.cd_hist = self.cd_hist / torch.sum(self.cd_hist)
-        x = [-1 + i * (2 / 40) + 1 / 40 for i in range(40)]
+        cd_hist = (self.cd_hist / torch.sum(self.cd_hist)).cpu()
         plt.figure()
         ax = plt.axes()
-        ax.plot(x, self.cd_hist)
+        ax.plot(self.cd_hist_bins, cd_hist)
         ax.set_xlim([-1, 1])
         ax.set_ylim([0, 0.4])
 
@@ -328,4 +374,4 @@ class Stego(pl.LightningModule):
         hist_vis = wandb.Image(hist_img, caption="Learned Feature Similarity Distribution")
         self.logger.experiment.log({"Histogram": hist_vis})
         img_buf.close()
-        self.cd_hist = torch.zeros(40)
+        self.cd_hist.zero_()
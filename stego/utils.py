@@ -121,6 +121,19 @@ def sample(t: torch.Tensor, coords: torch.Tensor):
     return F.grid_sample(t, coords.permute(0, 2, 1, 3), padding_mode="border", align_corners=True)
 
 
+def to_pinned_cpu(t: torch.Tensor):
+    """
+    Copies a CUDA tensor into pinned host memory with a non-blocking transfer.
+    The copy is asynchronous - synchronize the stream before reading the result.
+    CPU tensors are returned unchanged.
+    """
+    if not t.is_cuda:
+        return t
+    pinned = torch.empty_like(t, device="cpu", pin_memory=True)
+    pinned.copy_(t, non_blocking=True)
+    return pinned
+
+
 def sample_nonzero_locations(t, target_size):
     nonzeros = torch.nonzero(t)
     coords = torch.zeros(target_size, dtype=nonzeros.dtype, device=nonzeros.device)